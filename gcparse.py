@@ -3,7 +3,7 @@
 # No copyright, ninetythirty, February 2014.
 #
 # gcparse.py
-# Usage: gcparse.py [-h] [-n] [-a] mbox
+# Usage: gcparse.py [-h] [-n] [-a] [-c] mbox
 #
 # This program frees your Gmail chat/instant message history from Google. It
 # produces a nicely-formatted plain text record of your chats, organized by
@@ -55,6 +55,16 @@
 # If you want to manually fix conversation threading errors (see discussion
 # below), this option helpfully prints a list of out-of-order timestamps which
 # are very good proxies for type III threading errors.
+#
+# About JSON Lines export and the -c, --columnar option
+#
+# Every run also writes 'messages.jsonl' to the data directory: one JSON object
+# per message with the keys 'thread', 'from', 'to', 'ms', 'body' and 'style'
+# ('old' or 'new'). Addresses are never replaced by the name map. The thread ID
+# is a string because it doesn't fit in a JavaScript number. If you want to
+# load a very large history in one go, this option also writes the messages as
+# columns of raw binary arrays to 'columnar' in the data directory; see
+# 'columnar/index.json' for the file layout.
 
 # This program requires Python 3 and lxml (http://lxml.de).
 #
@@ -117,6 +127,7 @@
 # which are type III. 
 
 import argparse
+import array
 from collections import defaultdict
 import datetime
 import glob
@@ -377,7 +388,7 @@ def parse_old_conversations(mbox_file, xml_dir, addresses):
                     # Don't print duplicate messages (sometimes the entire
                     # message including timestamp is repeated), don't print
                     # empty messages
-                    print('  <message to="{0}" from="{1}">'.format(to_field, from_field), file=f)
+                    print('  <message to="{0}" from="{1}" style="old">'.format(to_field, from_field), file=f)
                     print('    <body>{0}</body>'.format(html.escape(body[0].text)), file=f)
                     print('    <time ms="{0}"/>'.format(time_ms), file=f)
                     print('  </message>', file=f)
@@ -439,7 +450,7 @@ def parse_new_conversations(mbox_file, xml_dir, addresses):
 
             # Write out data
             f = open('{0}/{1}.conv'.format(xml_dir, thread_id), 'a') # append
-            print('  <message to="{0}" from="{1}">'.format(to_field, from_field), file=f)
+            print('  <message to="{0}" from="{1}" style="new">'.format(to_field, from_field), file=f)
             print('    <body>{0}</body>'.format(html.escape(cleaned_payload)), file=f)
             print('    <time ms="{0}"/>'.format(timestamp_ms), file=f)
             print('  </message>', file=f)
@@ -589,6 +600,109 @@ def sort_text_conversations(source_dir, dest_dir):
     print('    Conversations with {0} people stored in \'{1}\''.format(num_conversations, os.path.basename(dest_dir)), file=sys.stdout)
     print('DONE', file=sys.stdout)
 
+# -----------------------------------------------------------------------------
+def iter_xml_messages(source_dir):
+    # Yield (thread, from, to, ms, body, style) for every message in the XML
+    # conversations, one at a time. iterparse() and clearing each element as
+    # we go keeps memory use flat no matter how big a conversation gets
+    for filename in glob.glob('{0}/*.conv'.format(source_dir)):
+        thread = os.path.basename(filename).split('.')[0]
+        for _, m in etree.iterparse(filename, tag='message'):
+            body = m.find('body').text or ''
+            ms = int(m.find('time').attrib['ms'])
+            # Data directories made before the style attribute was added don't
+            # have it, delete 'xml' in the data directory to regenerate
+            style = m.attrib.get('style', '')
+            yield thread, m.attrib['from'], m.attrib['to'], ms, body, style
+            m.clear()
+            while m.getprevious() is not None:
+                del m.getparent()[0]
+
+# -----------------------------------------------------------------------------
+def export_xml_conversations_as_json_lines(source_dir, dest_file):
+    print('Exporting XML conversations as JSON Lines... ', file=sys.stdout)
+    sys.stdout.flush()
+    num_messages = 0
+    keys = ('thread', 'from', 'to', 'ms', 'body', 'style')
+
+    # Write out data
+    with open(dest_file, 'w', encoding='utf-8') as f:
+        for message in iter_xml_messages(source_dir):
+            num_messages += 1
+            print(json.dumps(dict(zip(keys, message)), ensure_ascii=False), file=f)
+
+    print('    {0} messages stored in \'{1}\''.format(num_messages, os.path.basename(dest_file)), file=sys.stdout)
+    print('DONE', file=sys.stdout)
+
+# -----------------------------------------------------------------------------
+def export_xml_conversations_as_columns(source_dir, dest_dir):
+    # Write each message field to its own file as a raw array so a reader can
+    # load a whole column with a single array.fromfile() or numpy.fromfile().
+    # Addresses and styles are stored as small integer ids into tables in
+    # index.json. Bodies are UTF-8 concatenated into one file, body i is
+    # bytes body_offsets[i]:body_offsets[i+1]. Arrays are buffered and flushed
+    # every chunk_size messages to keep memory use flat
+    print('Exporting XML conversations as columns... ', file=sys.stdout)
+    sys.stdout.flush()
+    chunk_size = 65536
+    num_messages = 0
+    participants = {}
+    styles = {}
+    # name: (typecode, filename)
+    layout = {
+        'thread': ('Q', 'thread.u64'),
+        'from': ('I', 'from.u32'),
+        'to': ('I', 'to.u32'),
+        'ms': ('q', 'ms.i64'),
+        'style': ('B', 'style.u8'),
+        'body_offsets': ('Q', 'body_offsets.u64'),
+        }
+    columns = {}
+    files = {}
+    for name, (typecode, filename) in layout.items():
+        columns[name] = array.array(typecode)
+        files[name] = open('{0}/{1}'.format(dest_dir, filename), 'wb')
+    bodies_file = open('{0}/bodies.utf8'.format(dest_dir), 'wb')
+    # body_offsets has one more entry than there are messages
+    body_offset = 0
+    columns['body_offsets'].append(body_offset)
+
+    for thread, from_field, to_field, ms, body, style in iter_xml_messages(source_dir):
+        num_messages += 1
+        columns['thread'].append(int(thread))
+        columns['from'].append(participants.setdefault(from_field, len(participants)))
+        columns['to'].append(participants.setdefault(to_field, len(participants)))
+        columns['ms'].append(ms)
+        columns['style'].append(styles.setdefault(style, len(styles)))
+        encoded_body = body.encode('utf-8')
+        bodies_file.write(encoded_body)
+        body_offset += len(encoded_body)
+        columns['body_offsets'].append(body_offset)
+        if num_messages % chunk_size == 0:
+            for name in columns:
+                columns[name].tofile(files[name])
+                del columns[name][:]
+
+    # Write out data
+    for name in columns:
+        columns[name].tofile(files[name])
+        files[name].close()
+    bodies_file.close()
+    index = {
+        'count': num_messages,
+        'byteorder': sys.byteorder,
+        'columns': {name: {'file': filename, 'typecode': typecode} for name, (typecode, filename) in layout.items()},
+        'bodies': 'bodies.utf8',
+        # Position in the list is the id stored in the column
+        'participants': sorted(participants, key=participants.get),
+        'styles': sorted(styles, key=styles.get),
+        }
+    with open('{0}/index.json'.format(dest_dir), 'w') as f:
+        json.dump(index, f, indent=4)
+
+    print('    {0} messages stored in \'{1}\''.format(num_messages, os.path.basename(dest_dir)), file=sys.stdout)
+    print('DONE', file=sys.stdout)
+
 # -----------------------------------------------------------------------------
 def main(argv=None):
     if argv is None:
@@ -596,6 +710,7 @@ def main(argv=None):
     parser = argparse.ArgumentParser(description='Liberate your Google Gmail chats.')
     parser.add_argument('-n', '--no-wrap', help='don\'t wrap text-formatted chats at 79 chars', action='store_true')
     parser.add_argument('-a', '--analyze', help='print a list of possible conversation thread errors', action='store_true')
+    parser.add_argument('-c', '--columnar', help='also export messages as binary columns', action='store_true')
     parser.add_argument('mbox', help='Gmail archive (mbox format)')
     args = parser.parse_args(args=argv[1:])
 
@@ -608,6 +723,8 @@ def main(argv=None):
     chats_new_mbox = '{0}/chats_new.mbox'.format(data_dir)
     xml_dir = '{0}/xml'.format(data_dir)
     text_dir = '{0}/text'.format(data_dir)
+    jsonl_file = '{0}/messages.jsonl'.format(data_dir)
+    columnar_dir = '{0}/columnar'.format(data_dir)
     addresses = defaultdict(int)
     name_map = {}
 
@@ -653,6 +770,13 @@ def main(argv=None):
     for filename in glob.glob('{0}/*.conv.unsorted'.format(text_dir)):
         os.remove(filename)
 
+    # Export
+    export_xml_conversations_as_json_lines(xml_dir, jsonl_file)
+    if args.columnar:
+        shutil.rmtree(columnar_dir, ignore_errors=True)
+        os.mkdir(columnar_dir)
+        export_xml_conversations_as_columns(xml_dir, columnar_dir)
+
     if created_name_map:
         print('''
 A name map has been created at \'{0}/name_map\'.